@@ -1,37 +1,184 @@
 import os
-from flask import Flask, request, abort, jsonify
+import hashlib
+import orjson
+from flask import Flask, request, abort, jsonify, current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
+from flask.json import JSONEncoder
+from sqlalchemy import Integer, all_, bindparam, cast, delete, event, func, inspect, select, tablesample
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import Session, aliased, object_session
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 QUESTIONS_PER_PAGE = 10
+QUIZ_SAMPLE_SIZE = 50
+# Largest page number whose OFFSET still fits into the database's BIGINT type.
+MAX_PAGE = (2**63 - 1) // QUESTIONS_PER_PAGE + 1
+# Range of the database's INTEGER type, used for question ids.
+INTEGER_MIN = -2**31
+INTEGER_MAX = 2**31 - 1
+
+
+# Columns selected for a page of questions, matching the keys of Question.format().
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
 
 
 def paginate_questions(request, selection):
 # Helper function used to determine the which questions to display for a given page.
-  page = request.args.get('page', 1, type=int)
+# The selection is a query. Only the columns of the requested page are fetched and
+# turned straight into dicts, without building Question objects.
+  # Page numbers below 1 are treated as the first page, as OFFSET can't be negative,
+  # and page numbers are capped so that the OFFSET doesn't overflow. Pages past
+  # the last one are empty either way.
+  page = min(max(request.args.get('page', 1, type=int), 1), MAX_PAGE)
   start =  (page - 1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
 
-  questions = [question.format() for question in selection]
-  current_questions = questions[start:end]
+  rows = selection.with_entities(*QUESTION_COLUMNS).limit(QUESTIONS_PER_PAGE).offset(start).all()
+  current_questions = [row._asdict() for row in rows]
 
   return current_questions
 
+def paginate_questions_after(selection, after):
+# Helper function used for keyset pagination, i.e. "?after=<question id>". Instead of
+# skipping rows with OFFSET it seeks past the given id, so every page costs the same.
+# Returns the page and the id to request the next page with (None on the last page).
+  rows = (selection.with_entities(*QUESTION_COLUMNS).filter(Question.id > after)
+          .limit(QUESTIONS_PER_PAGE + 1).all())
+  current_questions = [row._asdict() for row in rows[:QUESTIONS_PER_PAGE]]
+  next_after = None
+  if len(rows) > QUESTIONS_PER_PAGE:
+    next_after = current_questions[-1]['id']
+
+  return current_questions, next_after
+
+def page_exists(request, total_questions):
+  # Helper function used to check that the requested page holds any questions,
+  # so that out of range pages can be rejected before the page is queried.
+  page = request.args.get('page', 1, type=int)
+  return page >= 1 and (page - 1) * QUESTIONS_PER_PAGE < total_questions
+
+def sampled_questions(sample_size):
+  # Helper function used to get a random sample of sample_size rows of the questions
+  # table, read from a few random pages (TABLESAMPLE SYSTEM_ROWS) instead of scanning it.
+  return aliased(
+    Question, tablesample(Question.__table__, func.system_rows(sample_size)))
+
+def pick_quiz_question(source, category, previous_questions):
+  # Helper function used to randomly pick a question for the quiz from the source,
+  # either the Question model or a sample returned by sampled_questions.
+  # Retrieve questions based on category, "0" represents ALL.
+  questions = db.session.query(source)
+  if (category != 0):
+    questions = questions.filter(source.category == category)
+
+  # Eliminate those that have been used already. The ids are sent as a single
+  # integer array parameter (id <> ALL(CAST(:previous_questions AS INTEGER[]))),
+  # so the SQL text doesn't grow with the number of previous questions.
+  questions = questions.filter(source.id != all_(
+    cast(bindparam('previous_questions', previous_questions), ARRAY(Integer))))
+
+  return questions.order_by(func.random()).limit(1).one_or_none()
+
+def get_json_body(request):
+  # Helper function used to parse the JSON body of a request with orjson.
+  # An empty body is treated as an empty object. A body which isn't sent as JSON,
+  # malformed JSON or JSON which isn't an object is a bad request.
+  data = request.get_data()
+  if not data:
+    return {}
+  if not request.is_json:
+    abort(400)
+  try:
+    body = orjson.loads(data)
+  except orjson.JSONDecodeError:
+    abort(400)
+  if not isinstance(body, dict):
+    abort(400)
+  return body
+
+def load_categories(bind):
+  # Helper function used to fetch all categories from the database.
+  # Only the id and type columns are selected, no ORM objects are built,
+  # and the rows are streamed from a server side cursor rather than buffered.
+  categories_query = bind.execution_options(stream_results=True).execute(
+    select([Category.id, Category.type]))
+  return {category_id: category_type
+          for category_id, category_type in categories_query}
+
 def get_categories():
-  # Helper function used to fetch and return all categories.
-  categories_query = Category.query.all()
-  categories = {}
-  for category in categories_query:
-    categories[category.id] = category.type
+  # Helper function used to return all categories.
+  # The categories are cached in the app config when the app is created.
+  categories, etag = current_app.config['CATEGORIES']
   return categories
 
+def cache_categories(config, bind):
+  # Helper function used to (re)build the categories cached in the app config,
+  # along with the ETag of the categories, a hash of their content. Both are
+  # stored as a single value, so a reader never gets them from different builds.
+  categories = load_categories(bind)
+  etag = hashlib.blake2b(
+    orjson.dumps(categories, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS),
+    digest_size=8).hexdigest()
+  config['CATEGORIES'] = (categories, etag)
+
+@event.listens_for(Category, 'after_insert')
+@event.listens_for(Category, 'after_update')
+@event.listens_for(Category, 'after_delete')
+def categories_written(mapper, connection, target):
+  # Mark the cached categories as stale when the categories table is written to.
+  # They are only rebuilt once the transaction is committed, see refresh_categories.
+  object_session(target).info['categories_dirty'] = True
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def categories_bulk_written(context):
+  # Bulk query updates and deletes don't fire the mapper events above.
+  if context.mapper is inspect(Category):
+    context.session.info['categories_dirty'] = True
+
+@event.listens_for(Session, 'after_commit')
+def refresh_categories(session):
+  # Rebuild the cached categories once writes to the categories table are committed.
+  # Committing a savepoint doesn't commit anything yet, so the flag is kept until then.
+  if session.transaction.nested or not session.info.get('categories_dirty'):
+    return
+  del session.info['categories_dirty']
+  if has_app_context():
+    cache_categories(current_app.config, session.get_bind(inspect(Category)))
+
+@event.listens_for(Session, 'after_rollback')
+def discard_categories_written(session):
+  # The writes were rolled back, so the cached categories are still current.
+  if not session.transaction.nested:
+    session.info.pop('categories_dirty', None)
+
+class OrjsonEncoder(JSONEncoder):
+  # JSON encoder used by jsonify, handing the serialization off to orjson.
+  # Types orjson doesn't know about fall back to Flask's default handling.
+  def encode(self, o):
+    option = orjson.OPT_NON_STR_KEYS
+    if self.sort_keys:
+      option |= orjson.OPT_SORT_KEYS
+    if self.indent:
+      option |= orjson.OPT_INDENT_2
+    return orjson.dumps(o, default=self.default, option=option).decode()
+
 def create_app(test_config=None):
   # Create and configure the app here.
   app = Flask(__name__)
-  setup_db(app)
+  app.json_encoder = OrjsonEncoder
+  app.config['QUIZ_SAMPLE_SIZE'] = QUIZ_SAMPLE_SIZE
+  # The tests pass the path of their own database in test_config.
+  if test_config is None:
+    setup_db(app)
+  else:
+    setup_db(app, test_config['database_path'])
+
+  # The categories rarely change, so they are loaded once here instead of on every request.
+  with app.app_context():
+    cache_categories(app.config, db.engine)
   
   '''
   @DONE: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
@@ -55,16 +202,26 @@ def create_app(test_config=None):
   '''
   @app.route('/categories')
   def retrieve_all_categories():
-    categories = get_categories()
+    # The categories and their ETag are read together, so that they match.
+    categories, etag = current_app.config['CATEGORIES']
 
     # Abort if no categories found in the databse, otherwise return all with "success".
     if len(categories) == 0:
       abort(404)
 
-    return jsonify({
-      'success': True,
-      'categories': categories
-    })
+    # Clients which already hold the current version of the categories get
+    # an empty "304 Not Modified", without the categories being serialized.
+    # If-None-Match uses the weak comparison, so a weak "W/" version of the
+    # ETag (as sent back by proxies which compress the response) matches as well.
+    if request.if_none_match.contains_weak(etag):
+      response = current_app.response_class(status=304)
+    else:
+      response = jsonify({
+        'success': True,
+        'categories': categories
+      })
+    response.set_etag(etag)
+    return response
 
   '''
   @DONE: 
@@ -80,20 +237,29 @@ def create_app(test_config=None):
   '''
   @app.route('/questions')
   def retrieve_all_questions():
-    selection = Question.query.all()
-    total_questions = len(selection)
-    current_questions = paginate_questions(request, selection)
-    categories = get_categories()
-    
-    #Abort if there are no questions in the database, 
+    selection = Question.query.order_by(Question.id)
+    total_questions = db.session.query(func.count(Question.id)).scalar()
+
+    #Abort if there are no questions on the requested page, 
     #otherwise return paginated questions, total questions and all categories. 
+    #Pages are selected either by number (?page=) or by the last id seen (?after=).
     
-    if len(current_questions) == 0:
-      abort(404)
+    after = request.args.get('after', None, type=int)
+    if after is None:
+      if not page_exists(request, total_questions):
+        abort(404)
+      current_questions = paginate_questions(request, selection)
+      next_after = None
+    else:
+      current_questions, next_after = paginate_questions_after(selection, after)
+      if len(current_questions) == 0:
+        abort(404)
+    categories = get_categories()
     return jsonify({
       'success': True,
       'questions': current_questions,
       'total_questions': total_questions,
+      'next_after': next_after,
       'categories': categories
     })
 
@@ -107,22 +273,24 @@ def create_app(test_config=None):
   @app.route('/questions/<int:id>', methods=['DELETE'])
   def delete_question(id):
       try:
-          question = Question.query.filter(Question.id == id).one_or_none()
+          # Delete the question in a single statement, which returns its id if it existed.
+          deleted = db.session.execute(
+              delete(Question).where(Question.id == id).returning(Question.id)).scalar()
+          db.session.commit()
 
           # If the question is not found, abort and return a "Not found" code.
-          if question is None:
+          if deleted is None:
               abort(404)
 
-          # Otherwise, delete the question and return paginated questions.
-          question.delete()
-          selection = Question.query.order_by(Question.id).all()
+          # Otherwise, return paginated questions.
+          selection = Question.query.order_by(Question.id)
           current_questions = paginate_questions(request, selection)
 
           return jsonify({
               'success': True,
               'deleted': id,
               'questions': current_questions,
-              'total_questions': len(Question.query.all())
+              'total_questions': db.session.query(func.count(Question.id)).scalar()
           })
 
       except:
@@ -149,7 +317,7 @@ def create_app(test_config=None):
   @app.route('/questions', methods=['POST'])
   def create_question():
     # First, need to parse JSON request data.
-    body = request.get_json()
+    body = get_json_body(request)
 
     new_question = body.get('question', None)
     new_answer = body.get('answer', None)
@@ -161,13 +329,16 @@ def create_app(test_config=None):
     try:
         # If the request is a search, process accordingly with case insensitivity.
         if search:
-          selection = Question.query.order_by(Question.id).filter(Question.question.ilike('%{}%'.format(search)))
+          # The search term is sent as a bound parameter, so the SQL text is
+          # identical for every search and its plan can be reused.
+          selection = Question.query.order_by(Question.id).filter(
+            Question.question.ilike(bindparam('search'))).params(search=f'%{search}%')
           current_questions = paginate_questions(request, selection)
 
           return jsonify({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(selection.all())
+            'total_questions': selection.with_entities(func.count()).order_by(None).scalar()
             })
         #Otherwise, the request is to post a new question and it must be handled accordingly.    
         else:
@@ -185,14 +356,14 @@ def create_app(test_config=None):
 
           # Retrieve paginated questions and send them back to the front end,
           # along with the id of the newly created question.
-          selection = Question.query.order_by(Question.id).all()
+          selection = Question.query.order_by(Question.id)
           current_questions = paginate_questions(request, selection)
 
           return jsonify({
             'success': True,
             'created': question.id,
             'questions': current_questions,
-            'total_questions': len(Question.query.all())
+            'total_questions': db.session.query(func.count(Question.id)).scalar()
           })
             
     except:
@@ -208,17 +379,25 @@ def create_app(test_config=None):
   '''
   @app.route('/categories/<int:id>/questions')
   def retrieve_questions_per_category(id):
-    selection = Question.query.filter(Question.category == id).all()
-    total_questions = len(selection)
-    current_questions = paginate_questions(request, selection)
+    selection = Question.query.filter(Question.category == id).order_by(Question.id)
+    total_questions = selection.with_entities(func.count()).order_by(None).scalar()
+
+    after = request.args.get('after', None, type=int)
+    if after is None:
+      if not page_exists(request, total_questions):
+        abort(404)
+      current_questions = paginate_questions(request, selection)
+      next_after = None
+    else:
+      current_questions, next_after = paginate_questions_after(selection, after)
+      if len(current_questions) == 0:
+        abort(404)
     categories = get_categories()
-
-    if len(current_questions) == 0:
-      abort(404)
     return jsonify({
       'success': True,
       'questions': current_questions,
       'total_questions': total_questions,
+      'next_after': next_after,
       'current_category': id,
       'categories': categories
     })
@@ -237,37 +416,34 @@ def create_app(test_config=None):
   @app.route('/quizzes', methods=['POST'])
   def retrieve_quiz_question():
 
-    body = request.get_json()
+    body = get_json_body(request)
     category = body.get('quiz_category', None)
     previous_questions = body.get('previous_questions')
 
-    if ((category is None) or (previous_questions is None)):
+    if ((category is None) or (previous_questions is None) or
+      (not isinstance(previous_questions, list))):
       abort(400)
     
-    # Format the data retrived from the request for use:
-    # (1) Need to get category "id" for use in the query.
-    category = int(category['id'])
-    # (2) Convert previous questions to a set in order 
-    # to more easily test if a question has been used before.
-    previous_questions = set(previous_questions)
-    
-    # Retrieve questions based on category, "0" represents ALL.
-    if (category == 0):
-        questions = Question.query.all()
-    else:
-        questions = Question.query.filter(Question.category == category).all()
-
-    # Build a list of possible questions, eliminating those that have been used already.
-    poss_qs = []
-    for question in questions:
-      if question.id not in previous_questions:
-        poss_qs.append(question)
+    # Need to get category "id" and the ids of the previous questions
+    # as integers for use in the query.
+    try:
+      category = int(category['id'])
+      previous_questions = [int(question_id) for question_id in previous_questions]
+    except (KeyError, TypeError, ValueError):
+      abort(400)
+    # Question ids outside the range of the INTEGER column can't be bound as INTEGER[].
+    if any(not (INTEGER_MIN <= question_id <= INTEGER_MAX)
+           for question_id in previous_questions):
+      abort(400)
     
-    # If the list of possible questions is not empty, randomly pick a question.
-    # Otherwise the game is over, just return success.
-    if len(poss_qs) > 0:
-      question = random.sample(poss_qs, 1)[0]
-      
+    # Let the database randomly pick a single unused question, first from a sample
+    # of the table and, if the sample holds none, from the whole table.
+    # If none is left the game is over, just return success.
+    sample = sampled_questions(current_app.config['QUIZ_SAMPLE_SIZE'])
+    question = (pick_quiz_question(sample, category, previous_questions) or
+                pick_quiz_question(Question, category, previous_questions))
+
+    if question is not None:
       return jsonify({
         'success': True, 
         'question': question.format()
@@ -15,6 +15,14 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Keep enough pooled connections for concurrent requests, check them
+    # before use and recycle them before the server drops idle ones.
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800
+    }
     db.app = app
     db.init_app(app)
     db.create_all()
@@ -1,22 +1,30 @@
 import os
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from models import db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case."""
 
+    @classmethod
+    def setUpClass(cls):
+        """ Initialize the app once for all tests, which also creates all tables."""
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgres://{}/{}".format('localhost:5432', cls.database_name)
+        cls.app = create_app({'database_path': cls.database_path})
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Executed after all tests, closes the pooled connections."""
+        with cls.app.app_context():
+            db.engine.dispose()
+
     def setUp(self):
-        """ Define test variables and initialize app."""
-        self.app = create_app()
+        """ Define test variables and start a transaction for the test."""
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}/{}".format('localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
 
         # This is a sample question to be used during the test
         # of the insertion endpoint.
@@ -33,16 +41,28 @@ class TriviaTestCase(unittest.TestCase):
             "quiz_category":{'type': 'Science', 'id': '1'}
             }
 
-        # Binds the app to the current context.
+        # Runs the session on a single connection inside an outer transaction.
+        # Commits made by the endpoints don't end that transaction, so it can be
+        # rolled back after the test. The app context is only pushed while setting
+        # this up, so that each request of the test client pushes (and tears down)
+        # its own context, and with it its own session, like in production.
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # Create all tables.
-            self.db.create_all()
+            self.connection = db.engine.connect()
+            self.transaction = self.connection.begin()
+            # The global session is replaced by one bound to that connection.
+            # The empty "binds" stops Flask-SQLAlchemy from binding the models
+            # to the engine again, which would let them bypass the connection.
+            self.session = db.session
+            db.session = db.create_scoped_session(
+                options={'bind': self.connection, 'binds': {}})
     
     def tearDown(self):
-        """ Executed after reach test."""
-        pass
+        """ Executed after reach test, undoes all changes made by the test."""
+        with self.app.app_context():
+            db.session.remove()
+            db.session = self.session
+            self.transaction.rollback()
+            self.connection.close()
 
     """
     DONE
@@ -57,6 +77,62 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['categories']))
 
+    def test_retrieve_categories_not_modified(self):
+        # Test that a client holding the current categories gets a "304 Not Modified".
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_retrieve_categories_not_modified_weak_etag(self):
+        # Test that a client sending back the weak version of the ETag
+        # also gets a "304 Not Modified".
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/categories', headers={'If-None-Match': 'W/' + etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_retrieve_categories_after_commit(self):
+        # Test that the cached categories include a new category once it is
+        # committed, and drop it again once its deletion is committed.
+        with self.app.app_context():
+            category = Category(type='Music')
+            db.session.add(category)
+            db.session.commit()
+            category_id = str(category.id)
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(data['categories'][category_id], 'Music')
+
+        with self.app.app_context():
+            category = Category.query.get(category_id)
+            db.session.delete(category)
+            db.session.commit()
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertNotIn(category_id, data['categories'])
+
+    def test_retrieve_categories_after_rollback(self):
+        # Test that a category which is flushed but never committed
+        # doesn't end up in the cached categories.
+        with self.app.app_context():
+            db.session.begin_nested()
+            category = Category(type='Music')
+            db.session.add(category)
+            db.session.flush()
+            category_id = str(category.id)
+            db.session.rollback()
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertNotIn(category_id, data['categories'])
+
     def test_retrieve_categories_fails(self):
         # Test for failed retrival of categories.
         res = self.client().get('/categories/100')
@@ -87,6 +163,44 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_retrieve_questions_after(self):
+        # Test for successful keyset paginated retrival of questions, where
+        # each page continues from the last question id of the previous one.
+        res = self.client().get('/questions?after=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['questions']), 10)
+        self.assertEqual(data['next_after'], data['questions'][-1]['id'])
+
+        res = self.client().get('/questions?after={}'.format(data['next_after']))
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(next_data['questions']))
+        self.assertTrue(next_data['questions'][0]['id'] > data['next_after'])
+
+    def test_retrieve_questions_after_last_question(self):
+        # Test for unsuccessful keyset paginated retrival of questions when
+        # there are no questions after the given id.
+        res = self.client().get('/questions?after=100000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_retrieve_questions_invalid_page(self):
+        # Test for unsuccessful paginated retrival of questions when
+        # the page number is not a positive number.
+        res = self.client().get('/questions?page=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
     def test_delete_question(self):
         # Test for the sucessful deletion of a question.
         res = self.client().delete('/questions/5')
@@ -100,6 +214,32 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertEqual(question, None)
 
+    def test_delete_question_invalid_page(self):
+        # Test that the deletion of a question succeeds when the page
+        # number is not a positive number, returning the first page.
+        res = self.client().delete('/questions/5?page=0')
+        data = json.loads(res.data)
+
+        question = Question.query.filter(Question.id == 5).one_or_none()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted'], 5)
+        self.assertTrue(len(data['questions']))
+        self.assertEqual(question, None)
+
+    def test_delete_question_beyond_valid_page(self):
+        # Test that the deletion of a question succeeds when the page is
+        # far beyond the available pages, returning an empty page.
+        res = self.client().delete('/questions/5?page=1000000000000000000')
+        data = json.loads(res.data)
+
+        question = Question.query.filter(Question.id == 5).one_or_none()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted'], 5)
+        self.assertEqual(len(data['questions']), 0)
+        self.assertEqual(question, None)
+
     def test_422_delete_if_question_does_not_exist(self):
         # Test for failure when the question to be deleted
         # doesn't exist.
@@ -121,6 +261,17 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
 
 
+    def test_create_new_question_invalid_page(self):
+        # Test that the creation of a new question succeeds when the page
+        # number is not a positive number, returning the first page.
+        res = self.client().post('/questions?page=0', json=self.new_question)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['created'])
+        self.assertTrue(len(data['questions']))
+
     def test_422_question_creation_fails(self):
         # Test the failure case for creating a new question.
         res = self.client().post('/questions', json={})
@@ -130,6 +281,29 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_question_creation_fails_bad_body(self):
+        # Test for the failure of creating a new question when the body
+        # is malformed JSON or isn't a JSON object.
+        for body in ['{"question":', '[]']:
+            res = self.client().post('/questions', data=body,
+                                     content_type='application/json')
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bad request')
+
+    def test_question_creation_fails_not_json(self):
+        # Test for the failure of creating a new question when the body
+        # isn't sent as JSON.
+        res = self.client().post('/questions', data=json.dumps(self.new_question),
+                                 content_type='text/plain')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_question_search_with_results(self):
         # Test for the successful retrieval of a search request.
         res = self.client().post('/questions', json={'searchTerm':'title'})
@@ -140,6 +314,17 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['questions']), 2)
 
+    def test_question_search_invalid_page(self):
+        # Test that a search succeeds when the page number is not
+        # a positive number, returning the first page of results.
+        res = self.client().post('/questions?page=0', json={'searchTerm':'title'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['total_questions'])
+        self.assertTrue(len(data['questions']))
+
     def test_question_search_without_results(self):
         # Test for the sucessful processing of a search with no results.
         res = self.client().post('/questions', json={'searchTerm':'BlahBlahBlahBlahBlah'})
@@ -161,6 +346,42 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['categories']))
 
+    def test_retrieve_questions_by_category_after(self):
+        # Test for successful keyset paginated retrival of questions by a given
+        # category, which only returns questions of that category.
+        res = self.client().get('/categories/2/questions?after=17')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([q['id'] for q in data['questions']], [18, 19])
+        self.assertEqual(data['next_after'], None)
+        self.assertEqual(data['current_category'], 2)
+
+    def test_retrieve_questions_by_category_after_next_page(self):
+        # Test that keyset pagination by category returns the id to continue
+        # from when the category holds more than one page of questions.
+        with self.app.app_context():
+            for i in range(QUESTIONS_PER_PAGE):
+                Question(question='Science question {}'.format(i), answer='Answer',
+                         category=1, difficulty=1).insert()
+
+        res = self.client().get('/categories/1/questions?after=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        self.assertTrue(all(int(q['category']) == 1 for q in data['questions']))
+        self.assertEqual(data['next_after'], data['questions'][-1]['id'])
+
+        res = self.client().get('/categories/1/questions?after={}'.format(data['next_after']))
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(next_data['questions']))
+        self.assertTrue(all(int(q['category']) == 1 for q in next_data['questions']))
+        self.assertEqual(next_data['next_after'], None)
+
     def test_fail_retrieve_questions_bad_category(self):
         # Test for unsuccessful paginated retrival of questions when 
         # the category does not exist.
@@ -179,7 +400,64 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
-        self.assertTrue(len(data['question']))
+        self.assertIn(data['question']['id'], [20, 21])
+
+    def test_quiz_excludes_previous_questions(self):
+        # Test that the quiz returns the only question of the category
+        # that has not previously been used.
+        res = self.client().post('/quizzes', json={
+            "previous_questions":[20, 21],
+            "quiz_category":{'type': 'Science', 'id': '1'}
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 22)
+
+    def test_quiz_all_categories(self):
+        # Test that the quiz picks from all categories when the category is "0".
+        res = self.client().post('/quizzes', json={
+            "previous_questions":[2, 4, 5, 6, 9, 10, 11, 12, 13, 14,
+                                  15, 16, 17, 18, 19, 20, 21, 22],
+            "quiz_category":{'type': 'click', 'id': 0}
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 23)
+
+    def test_quiz_without_sample(self):
+        # Test that the quiz falls back to the whole table when the
+        # sample of the table holds no unused question of the category.
+        sample_size = self.app.config['QUIZ_SAMPLE_SIZE']
+        self.app.config['QUIZ_SAMPLE_SIZE'] = 0
+        try:
+            res = self.client().post('/quizzes', json={
+                "previous_questions":[20, 21],
+                "quiz_category":{'type': 'Science', 'id': '1'}
+                })
+        finally:
+            self.app.config['QUIZ_SAMPLE_SIZE'] = sample_size
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 22)
+
+    def test_quiz_game_over(self):
+        # Test that the quiz returns no question once all questions
+        # of the category have been used.
+        res = self.client().post('/quizzes', json={
+            "previous_questions":[20, 21, 22],
+            "quiz_category":{'type': 'Science', 'id': '1'}
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertNotIn('question', data)
 
     def test_quiz_fail(self):
         # Test for the failure of the quiz when a bad 
@@ -191,6 +469,44 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'bad request')
 
+    def test_quiz_previous_questions_as_strings(self):
+        # Test that the ids of previous questions sent as strings are accepted.
+        res = self.client().post('/quizzes', json={
+            "previous_questions":["20", "21"],
+            "quiz_category":{'type': 'Science', 'id': '1'}
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 22)
+
+    def test_quiz_fail_bad_body(self):
+        # Test for the failure of the quiz when the body is malformed
+        # JSON or isn't a JSON object.
+        for body in ['{"previous_questions":', '[]']:
+            res = self.client().post('/quizzes', data=body,
+                                     content_type='application/json')
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bad request')
+
+    def test_quiz_fail_bad_previous_questions(self):
+        # Test for the failure of the quiz when the previous questions
+        # are not a list of question ids.
+        for previous_questions in ["22", ["abc"], [None], [3000000000]]:
+            res = self.client().post('/quizzes', json={
+                "previous_questions":previous_questions,
+                "quiz_category":{'type': 'Science', 'id': '1'}
+                })
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message'], 'bad request')
+
 # Make the tests conveniently executable.
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file